@@ -34,12 +34,25 @@ You can also send multiple records at once:
 import os
 import json
 import time
+import queue
+import signal
 import sqlite3
 import logging
-from datetime import datetime
+import threading
+from functools import lru_cache
+from operator import itemgetter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 import paho.mqtt.client as mqtt
 import uuid
 import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    import orjson
+except ImportError:
+    # orjson has no prebuilt wheels for every add-on architecture (armhf)
+    orjson = None
 
 # Set up logging
 logging.basicConfig(
@@ -60,9 +73,68 @@ DEFAULT_CONFIG = {
     "ha_token": "",
     "max_timestamp_offset_days": 30,  # Limit how far back in time we'll accept
     "default_entity_id_prefix": "sensor.",
-    "create_missing_entities": True
+    "create_missing_entities": True,
+    "bulk_import_mode": False,  # Skip fsyncs while importing large histories
+    "max_payload_bytes": 262144  # Larger MQTT payloads are rejected unparsed
 }
 
+# Database writer batching
+BATCH_SIZE = 500  # Flush after this many queued records
+FLUSH_INTERVAL = 2.0  # ...or after this many seconds
+
+# Backpressure: bound what is buffered in memory between MQTT and the database
+WRITE_QUEUE_SIZE = 10000  # Decoded records waiting for the writer
+MAX_PENDING_MESSAGES = 100  # Raw payloads waiting for a decode worker
+
+# MQTT keepalive in seconds. A stalled writer blocks the network loop through
+# backpressure, so a batch's worst-case write time must stay below this
+MQTT_KEEPALIVE = 60
+
+# The recorder can hold its write lock for a while; wait for it, then retry.
+# Worst case per batch: 3 x 10 s busy waits + 2 s + 4 s of delays = 36 s
+DB_BUSY_TIMEOUT = 10.0  # Seconds sqlite waits for a lock before failing
+DB_WRITE_ATTEMPTS = 3  # Attempts per batch when the database stays locked
+DB_RETRY_DELAY = 2.0  # Seconds between attempts, multiplied by the attempt number
+
+# In bulk import mode, checkpoint the WAL after this many batches
+BULK_CHECKPOINT_BATCHES = 50
+
+# Shared SQL text, so sqlite's statement cache compiles each statement once
+INSERT_STATE_SQL = (
+    "INSERT INTO states (entity_id, state, last_changed, last_updated, old_state_id, attributes_id) "
+    "VALUES (?, ?, ?, ?, NULL, ?)"
+)
+INSERT_ATTRIBUTES_SQL = "INSERT INTO state_attributes (shared_attrs) VALUES (?)"
+INSERT_HASHED_ATTRIBUTES_SQL = "INSERT INTO state_attributes (hash, shared_attrs) VALUES (?, ?)"
+SELECT_ATTRIBUTES_SQL = "SELECT attributes_id FROM state_attributes WHERE shared_attrs = ?"
+SELECT_HASHED_ATTRIBUTES_SQL = "SELECT attributes_id FROM state_attributes WHERE hash = ? AND shared_attrs = ?"
+
+# Maximum number of cached shared_attrs -> attributes_id entries
+ATTR_ID_CACHE_SIZE = 4096
+
+# Accepted timestamp formats when ISO 8601 parsing fails
+TIMESTAMP_FORMATS = [
+    "%Y-%m-%dT%H:%M:%S.%fZ",
+    "%Y-%m-%dT%H:%M:%SZ",
+    "%Y-%m-%dT%H:%M:%S.%f",
+    "%Y-%m-%dT%H:%M:%S",
+    "%Y-%m-%d %H:%M:%S.%f",
+    "%Y-%m-%d %H:%M:%S",
+    "%Y-%m-%d"
+]
+
+def json_loads(data):
+    """Parse JSON from bytes or str, with orjson when it is installed."""
+    if orjson:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def json_dumps(obj):
+    """Serialize to compact JSON text, the form Home Assistant stores."""
+    if orjson:
+        return orjson.dumps(obj).decode()
+    return json.dumps(obj, separators=(',', ':'), ensure_ascii=False)
+
 def load_config():
     """Load the addon configuration."""
     config_path = "/data/options.json"
@@ -84,7 +156,7 @@ def load_config():
 def verify_ha_database(db_path):
     """Verify that the Home Assistant database exists and has the expected schema."""
     if not os.path.exists(db_path):
-        logger.error(f"Home Assistant database not found at {db_path}")
+        logger.error("Home Assistant database not found at %s", db_path)
         return False
     
     try:
@@ -97,16 +169,57 @@ def verify_ha_database(db_path):
         table_names = [table[0] for table in tables]
         
         if 'states' not in table_names or 'state_attributes' not in table_names:
-            logger.error(f"Required tables not found in Home Assistant database. Found: {table_names}")
+            logger.error("Required tables not found in Home Assistant database. Found: %s", table_names)
             conn.close()
             return False
             
         conn.close()
-        logger.info(f"Home Assistant database verified at {db_path}")
+        logger.info("Home Assistant database verified at %s", db_path)
         return True
     except Exception as e:
-        logger.error(f"Error verifying Home Assistant database: {e}")
+        logger.error("Error verifying Home Assistant database: %s", e)
+        return False
+
+def open_ha_database(db_path, bulk_import_mode=False):
+    """Open the long-lived connection to the Home Assistant database.
+    
+    The connection runs in autocommit mode; writers manage their own
+    transactions with explicit BEGIN IMMEDIATE/COMMIT. In bulk import mode
+    commits are not synced to disk at all.
+    """
+    conn = sqlite3.connect(db_path, timeout=DB_BUSY_TIMEOUT, isolation_level=None, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    if bulk_import_mode:
+        conn.execute("PRAGMA synchronous=OFF")
+    else:
+        conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-20000")
+    conn.execute("PRAGMA mmap_size=268435456")
+    return conn
+
+def is_database_busy(error):
+    """Check whether a sqlite error is a transient busy or locked condition."""
+    if not isinstance(error, sqlite3.OperationalError):
         return False
+    # sqlite_errorcode is available on Python 3.11+
+    code = getattr(error, 'sqlite_errorcode', None)
+    if code is not None:
+        return code & 0xFF in (sqlite3.SQLITE_BUSY, sqlite3.SQLITE_LOCKED)
+    message = str(error)
+    return 'locked' in message or 'busy' in message
+
+def checkpoint_database(conn, mode):
+    """Checkpoint the WAL into the database file and sync it to disk.
+    
+    With synchronous=OFF a checkpoint skips its fsync, so bulk import mode
+    switches to NORMAL for the checkpoint and back to OFF afterwards.
+    """
+    conn.execute("PRAGMA synchronous=NORMAL")
+    try:
+        conn.execute(f"PRAGMA wal_checkpoint({mode})")
+    finally:
+        conn.execute("PRAGMA synchronous=OFF")
 
 def get_entity_id_from_topic(topic):
     """Extract entity_id from MQTT topic.
@@ -114,19 +227,31 @@ def get_entity_id_from_topic(topic):
     Expected format: homeassistant/history/sensor.bedroom_temperature
     Will return: sensor.bedroom_temperature
     """
-    parts = topic.split('/')
+    # Stop splitting after the third level; deeper levels are not needed
+    parts = topic.split('/', 3)
     if len(parts) >= 3:
         return parts[2]
     return None
 
-def check_entity_exists(conn, entity_id):
-    """Check if an entity exists in the Home Assistant database."""
+def load_known_entities(conn):
+    """Load the set of entity_ids that already have states in the database."""
     cursor = conn.cursor()
-    cursor.execute("SELECT entity_id FROM states WHERE entity_id = ? LIMIT 1", (entity_id,))
-    result = cursor.fetchone()
-    return result is not None
+    cursor.execute("SELECT DISTINCT entity_id FROM states")
+    return set(row[0] for row in cursor)
+
+def create_http_session(config):
+    """Create a keep-alive HTTP session for the Home Assistant API."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=4)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers.update({
+        "Authorization": f"Bearer {config['ha_token']}",
+        "Content-Type": "application/json"
+    })
+    return session
 
-def create_entity_via_api(config, entity_id, attributes=None):
+def create_entity_via_api(session, config, entity_id, attributes=None):
     """Create an entity using the Home Assistant API."""
     if not config["ha_token"]:
         logger.error("No Home Assistant API token provided, cannot create entity")
@@ -139,7 +264,7 @@ def create_entity_via_api(config, entity_id, attributes=None):
     # Extract domain and object_id from entity_id
     parts = entity_id.split('.')
     if len(parts) != 2:
-        logger.error(f"Invalid entity_id format: {entity_id}")
+        logger.error("Invalid entity_id format: %s", entity_id)
         return False
         
     domain, object_id = parts
@@ -152,24 +277,18 @@ def create_entity_via_api(config, entity_id, attributes=None):
     # Format depends on entity type
     if domain == 'sensor':
         # Create a sensor entity
-        headers = {
-            "Authorization": f"Bearer {config['ha_token']}",
-            "Content-Type": "application/json"
-        }
-        
-        # First, check if entity already exists via API
+        # First, check if entity already exists via API. It can be live in
+        # Home Assistant without any rows in states, and POSTing would
+        # overwrite its current state
         try:
-            response = requests.get(
-                f"{config['ha_api_url']}/states/{entity_id}",
-                headers=headers
-            )
+            response = session.get(f"{config['ha_api_url']}/states/{entity_id}")
             
             if response.status_code == 200:
-                logger.info(f"Entity {entity_id} already exists according to API")
+                logger.info("Entity %s already exists according to API", entity_id)
                 return True
                 
         except Exception as e:
-            logger.error(f"Error checking entity via API: {e}")
+            logger.error("Error checking entity via API: %s", e)
         
         # Create entity via API
         try:
@@ -178,84 +297,70 @@ def create_entity_via_api(config, entity_id, attributes=None):
                 "attributes": attributes
             }
             
-            response = requests.post(
+            response = session.post(
                 f"{config['ha_api_url']}/states/{entity_id}",
-                headers=headers,
                 json=payload
             )
             
             if response.status_code in (200, 201):
-                logger.info(f"Successfully created entity {entity_id} via API")
+                logger.info("Successfully created entity %s via API", entity_id)
                 return True
             else:
-                logger.error(f"Failed to create entity via API: {response.status_code} - {response.text}")
+                logger.error("Failed to create entity via API: %s - %s", response.status_code, response.text)
                 return False
                 
         except Exception as e:
-            logger.error(f"Error creating entity via API: {e}")
+            logger.error("Error creating entity via API: %s", e)
             return False
     else:
         # Other entity types might need different approaches
-        logger.warning(f"Creating entities of domain {domain} is not fully supported")
+        logger.warning("Creating entities of domain %s is not fully supported", domain)
         return False
 
-def create_entity_in_db(conn, entity_id, attributes=None):
-    """Create an entity directly in the Home Assistant database."""
+def create_entity_in_db(conn, entity_id, attributes=None, has_hash=False):
+    """Create an entity directly in the Home Assistant database.
+    
+    Callers check the known entities cache first, so existence is not re-checked here.
+    """
     try:
         cursor = conn.cursor()
         
-        # Check if entity already exists
-        if check_entity_exists(conn, entity_id):
-            logger.info(f"Entity {entity_id} already exists in database")
-            return True
-            
         # Convert attributes to JSON
         attributes_json = None
         if attributes:
-            attributes_json = json.dumps(attributes)
+            attributes_json = json_dumps(attributes)
         
         # Get current timestamp
-        now = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%fZ")
-        
-        # Insert initial state
-        cursor.execute(
-            "INSERT INTO states (entity_id, state, last_changed, last_updated, old_state_id, attributes_id) "
-            "VALUES (?, ?, ?, ?, NULL, NULL)",
-            (entity_id, "unknown", now, now)
-        )
+        now = format_timestamp(datetime.utcnow())
         
-        state_id = cursor.lastrowid
+        cursor.execute("BEGIN IMMEDIATE")
         
-        # Insert attributes if provided
+        # Insert attributes first so the state row can reference them directly
+        attributes_id = None
         if attributes_json:
-            # Insert into state_attributes
-            cursor.execute("INSERT INTO state_attributes (shared_attrs) VALUES (?)", (attributes_json,))
-            attributes_id = cursor.lastrowid
-            
-            # Update states record with attributes_id
-            cursor.execute(
-                "UPDATE states SET attributes_id = ? WHERE state_id = ?", 
-                (attributes_id, state_id)
-            )
+            attributes_id = insert_attributes_row(cursor, attributes_json, has_hash)
+        
+        # Insert initial state
+        cursor.execute(INSERT_STATE_SQL, (entity_id, "unknown", now, now, attributes_id))
         
         conn.commit()
-        logger.info(f"Successfully created entity {entity_id} in database")
+        logger.info("Successfully created entity %s in database", entity_id)
         return True
         
     except Exception as e:
-        logger.error(f"Error creating entity in database: {e}")
+        logger.error("Error creating entity in database: %s", e)
         conn.rollback()
         return False
 
-def create_entity(conn, config, entity_id, attributes=None):
+def create_entity(conn, session, config, entity_id, attributes=None, has_hash=False):
     """Create an entity using the appropriate method."""
     # Try API method first (preferred)
     if config.get("ha_token"):
-        if create_entity_via_api(config, entity_id, attributes):
+        if create_entity_via_api(session, config, entity_id, attributes):
             return True
     
     # Fallback to direct DB method
-    return create_entity_in_db(conn, entity_id, attributes)
+    return create_entity_in_db(conn, entity_id, attributes, has_hash)
 
 def get_last_state_id(conn, entity_id):
     """Get the last state_id for an entity."""
@@ -267,89 +372,135 @@ def get_last_state_id(conn, entity_id):
     result = cursor.fetchone()
     return result[0] if result else None
 
-def insert_state_attribute(conn, state_id, attributes):
-    """Insert state attributes into the database."""
-    if not attributes:
-        return
-    
+@lru_cache(maxsize=1024)
+def _encode_attributes(items):
+    """Serialize a hashable tuple of (key, type, value) attribute items to JSON."""
+    return json_dumps({key: value for key, _, value in items})
+
+def encode_attributes(attributes):
+    """Serialize attributes to JSON, reusing the result for repeated attributes."""
     try:
-        cursor = conn.cursor()
+        # Include the type: 1, 1.0 and True are equal keys but different JSON
+        return _encode_attributes(tuple((key, type(value), value) for key, value in attributes.items()))
+    except TypeError:
+        # Unhashable values (lists, nested dicts) can't be cached
+        return json_dumps(attributes)
+
+def has_attributes_hash(conn):
+    """Check whether state_attributes has Home Assistant's indexed hash column."""
+    cursor = conn.cursor()
+    cursor.execute("PRAGMA table_info(state_attributes)")
+    return any(row[1] == 'hash' for row in cursor)
+
+def attributes_hash(shared_attrs):
+    """Compute the FNV-1a 32-bit hash Home Assistant stores in state_attributes.hash."""
+    value = 0x811C9DC5
+    for byte in shared_attrs.encode():
+        value = ((value ^ byte) * 0x01000193) & 0xFFFFFFFF
+    return value
+
+def insert_attributes_row(cursor, shared_attrs, has_hash):
+    """Insert a state_attributes row and return its attributes_id."""
+    if has_hash:
+        cursor.execute(INSERT_HASHED_ATTRIBUTES_SQL, (attributes_hash(shared_attrs), shared_attrs))
+    else:
+        cursor.execute(INSERT_ATTRIBUTES_SQL, (shared_attrs,))
+    return cursor.lastrowid
+
+def insert_state_attribute(conn, attributes, attr_id_cache, has_hash=False):
+    """Return the attributes_id for the given shared attributes, inserting them if needed.
+    
+    attr_id_cache maps shared_attrs to attributes_id so repeated attributes
+    skip the lookup query. With has_hash the lookup goes through the indexed
+    hash column instead of comparing the full JSON text.
+    """
+    attributes_id = attr_id_cache.get(attributes)
+    if attributes_id is not None:
+        return attributes_id
         
-        # Check if shared_attrs exists
-        cursor.execute("SELECT attributes_id FROM state_attributes WHERE shared_attrs = ?", (attributes,))
-        existing = cursor.fetchone()
+    if len(attr_id_cache) >= ATTR_ID_CACHE_SIZE:
+        attr_id_cache.clear()
+    
+    cursor = conn.cursor()
+    
+    # Check if shared_attrs exists
+    if has_hash:
+        cursor.execute(SELECT_HASHED_ATTRIBUTES_SQL, (attributes_hash(attributes), attributes))
+    else:
+        cursor.execute(SELECT_ATTRIBUTES_SQL, (attributes,))
+    existing = cursor.fetchone()
+    
+    if existing:
+        # Re-use existing attributes
+        attributes_id = existing[0]
+    else:
+        # Insert new attributes
+        attributes_id = insert_attributes_row(cursor, attributes, has_hash)
         
-        if existing:
-            # Re-use existing attributes
-            cursor.execute(
-                "UPDATE states SET attributes_id = ? WHERE state_id = ?", 
-                (existing[0], state_id)
-            )
-        else:
-            # Insert new attributes
-            cursor.execute("INSERT INTO state_attributes (shared_attrs) VALUES (?)", (attributes,))
-            attributes_id = cursor.lastrowid
-            
-            cursor.execute(
-                "UPDATE states SET attributes_id = ? WHERE state_id = ?", 
-                (attributes_id, state_id)
-            )
-    except Exception as e:
-        logger.error(f"Error inserting attributes: {e}")
+    attr_id_cache[attributes] = attributes_id
+    return attributes_id
 
-def insert_historical_state(conn, entity_id, state, timestamp, attributes_json=None):
-    """Insert a historical state into the Home Assistant database."""
-    try:
-        cursor = conn.cursor()
-        
-        # Format the timestamp to match Home Assistant's format
-        if 'T' not in timestamp:
-            # If only date is provided, assume midnight
-            timestamp = f"{timestamp}T00:00:00"
+def insert_historical_states(conn, rows, attr_id_cache, has_hash=False):
+    """Insert a batch of historical states into the Home Assistant database.
+    
+    Each row is an (entity_id, state, timestamp, attributes_json) tuple
+    with the timestamp already in Home Assistant's format. The whole batch
+    is written in a single transaction, which is retried while the database
+    is locked.
+    """
+    for attempt in range(1, DB_WRITE_ATTEMPTS + 1):
+        try:
+            cursor = conn.cursor()
+            # Take the write lock up front: the attribute lookups below would
+            # otherwise start a read snapshot that can't be upgraded once the
+            # recorder commits, failing without waiting on the busy timeout
+            cursor.execute("BEGIN IMMEDIATE")
             
-        if '.' not in timestamp and 'Z' not in timestamp:
-            # Add milliseconds if not present
-            timestamp = f"{timestamp}.000000"
+            params = []
+            for entity_id, state, timestamp, attributes_json in rows:
+                # Resolve attributes before the insert so no follow-up UPDATE is needed
+                attributes_id = None
+                if attributes_json:
+                    attributes_id = insert_state_attribute(conn, attributes_json, attr_id_cache, has_hash)
+                    
+                params.append((entity_id, state, timestamp, timestamp, attributes_id))
             
-        if 'Z' not in timestamp and '+' not in timestamp:
-            # Add timezone if not present
-            timestamp = f"{timestamp}Z"
+            # Create state entries
+            cursor.executemany(INSERT_STATE_SQL, params)
             
-        # Create state entry
-        cursor.execute(
-            "INSERT INTO states (entity_id, state, last_changed, last_updated, old_state_id, attributes_id) "
-            "VALUES (?, ?, ?, ?, NULL, NULL)",
-            (entity_id, state, timestamp, timestamp)
-        )
-        
-        state_id = cursor.lastrowid
-        
-        # Insert attributes if provided
-        if attributes_json:
-            insert_state_attribute(conn, state_id, attributes_json)
-        
-        conn.commit()
-        return True
-    except Exception as e:
-        logger.error(f"Error inserting historical state: {e}")
-        conn.rollback()
-        return False
+            conn.commit()
+            return True
+        except Exception as e:
+            conn.rollback()
+            # Ids inserted by this transaction are gone
+            attr_id_cache.clear()
+            
+            # Locked or busy database: wait for the recorder and try again.
+            # Anything else (schema or I/O errors) won't fix itself
+            if is_database_busy(e) and attempt < DB_WRITE_ATTEMPTS:
+                delay = DB_RETRY_DELAY * attempt
+                logger.warning("Error inserting historical states: %s, retrying in %s seconds (attempt %s of %s)",
+                               e, delay, attempt, DB_WRITE_ATTEMPTS)
+                time.sleep(delay)
+                continue
+                
+            logger.error("Error inserting historical states: %s", e)
+            return False
 
 def parse_timestamp(timestamp_str):
     """Parse timestamp string to datetime object."""
     try:
-        # Try various formats
-        formats = [
-            "%Y-%m-%dT%H:%M:%S.%fZ",
-            "%Y-%m-%dT%H:%M:%SZ",
-            "%Y-%m-%dT%H:%M:%S.%f",
-            "%Y-%m-%dT%H:%M:%S",
-            "%Y-%m-%d %H:%M:%S.%f",
-            "%Y-%m-%d %H:%M:%S",
-            "%Y-%m-%d"
-        ]
+        # Fast path for ISO 8601, which covers nearly all payloads
+        try:
+            parsed = datetime.fromisoformat(timestamp_str.rstrip('Z'))
+            if parsed.tzinfo:
+                parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+            return parsed
+        except ValueError:
+            pass
         
-        for fmt in formats:
+        # Fall back to the explicit formats
+        for fmt in TIMESTAMP_FORMATS:
             try:
                 return datetime.strptime(timestamp_str, fmt)
             except ValueError:
@@ -357,22 +508,30 @@ def parse_timestamp(timestamp_str):
                 
         raise ValueError(f"Could not parse timestamp: {timestamp_str}")
     except Exception as e:
-        logger.error(f"Error parsing timestamp {timestamp_str}: {e}")
+        logger.error("Error parsing timestamp %s: %s", timestamp_str, e)
         return None
 
-def is_timestamp_valid(timestamp_str, max_offset_days):
-    """Check if timestamp is valid and not too far in the past or future."""
-    parsed = parse_timestamp(timestamp_str)
-    if not parsed:
-        return False
-        
-    now = datetime.now()
+def format_timestamp(parsed):
+    """Format a parsed timestamp to match Home Assistant's format."""
+    return f"{parsed.isoformat(timespec='microseconds')}Z"
+
+def is_timestamp_valid(parsed, max_offset_days, now=None):
+    """Check if a parsed timestamp is not too far in the past or future.
+    
+    Pass now to validate a whole batch of records against the same clock reading.
+    """
+    if now is None:
+        now = datetime.now()
     diff = abs((now - parsed).days)
     
     return diff <= max_offset_days
 
-def process_single_record(conn, config, entity_id, record, max_offset_days):
-    """Process a single historical record."""
+def process_single_record(entity_id, record, max_offset_days, now=None):
+    """Validate a single historical record and convert it to a row for the writer.
+    
+    Returns an (entity_id, state, timestamp, attributes_json) tuple, or None
+    if the record is invalid.
+    """
     try:
         # Extract data
         state = str(record.get('state', ''))
@@ -381,28 +540,34 @@ def process_single_record(conn, config, entity_id, record, max_offset_days):
         
         # Validate data
         if not state or not timestamp:
-            logger.error(f"Missing required fields (state or timestamp) in record: {record}")
-            return False
+            logger.error("Missing required fields (state or timestamp) in record: %s", record)
+            return None
             
         # Validate timestamp
-        if not is_timestamp_valid(timestamp, max_offset_days):
-            logger.error(f"Timestamp {timestamp} is invalid or too far from current time")
-            return False
+        parsed = parse_timestamp(timestamp)
+        if not parsed or not is_timestamp_valid(parsed, max_offset_days, now):
+            logger.error("Timestamp %s is invalid or too far from current time", timestamp)
+            return None
             
+        # Normalize from the parsed value rather than patching the string
+        timestamp = format_timestamp(parsed)
+        
         # Convert attributes to JSON if needed
-        attributes_json = json.dumps(attributes) if attributes else None
+        attributes_json = encode_attributes(attributes) if attributes else None
         
-        # Insert state
-        return insert_historical_state(conn, entity_id, state, timestamp, attributes_json)
+        return (entity_id, state, timestamp, attributes_json)
     except Exception as e:
-        logger.error(f"Error processing record: {e}")
-        return False
+        logger.error("Error processing record: %s", e)
+        return None
 
-def process_message(conn, config, topic, payload):
-    """Process an MQTT message containing historical data."""
+def process_message(config, write_queue, topic, payload):
+    """Process an MQTT message containing historical data.
+    
+    Valid records are queued for the database writer thread.
+    """
     try:
         # Parse payload
-        data = json.loads(payload)
+        data = json_loads(payload)
         
         # Extract entity_id from topic
         entity_id = get_entity_id_from_topic(topic)
@@ -415,79 +580,178 @@ def process_message(conn, config, topic, payload):
                 entity_id = f"{config['default_entity_id_prefix']}{data['device_id']}"
                 
         if not entity_id:
-            logger.error(f"Could not determine entity_id from topic {topic} or payload")
+            logger.error("Could not determine entity_id from topic %s or payload", topic)
             return False
-            
-        # Extract attributes for entity creation
-        attributes = None
-        if 'records' in data and isinstance(data['records'], list) and data['records']:
-            # Get attributes from the first record
-            attributes = data['records'][0].get('attributes', {})
-        else:
-            # Get attributes from the single record
-            attributes = data.get('attributes', {})
-            
-        # Check if entity exists and create if needed
-        if not check_entity_exists(conn, entity_id):
-            if config['create_missing_entities']:
-                logger.info(f"Entity {entity_id} does not exist. Creating it...")
-                if not create_entity(conn, config, entity_id, attributes):
-                    logger.error(f"Failed to create entity {entity_id}")
-                    return False
-            else:
-                logger.warning(f"Entity {entity_id} does not exist and creation is disabled")
         
         # Process records
-        success = False
         if 'records' in data and isinstance(data['records'], list):
             # Process multiple records
-            for record in data['records']:
-                if process_single_record(conn, config, entity_id, record, config['max_timestamp_offset_days']):
-                    success = True
+            records = data['records']
         else:
             # Process single record
-            success = process_single_record(conn, config, entity_id, data, config['max_timestamp_offset_days'])
+            records = [data]
+            
+        success = False
+        max_offset_days = config['max_timestamp_offset_days']
+        now = datetime.now()
+        for record in records:
+            row = process_single_record(entity_id, record, max_offset_days, now)
+            if row:
+                write_queue.put(row)
+                success = True
             
         return success
     except json.JSONDecodeError:
-        logger.error(f"Invalid JSON payload: {payload}")
+        logger.error("Invalid JSON payload on topic %s (%s bytes)", topic, len(payload))
         return False
     except Exception as e:
-        logger.error(f"Error processing message: {e}")
+        logger.error("Error processing message: %s", e)
         return False
 
+def ensure_entities(userdata, rows):
+    """Make sure every entity in a batch exists, creating it if needed.
+    
+    Returns the rows that can be written; rows for entities that could
+    not be created are dropped.
+    """
+    config = userdata['config']
+    known_entities = userdata['known_entities']
+    
+    failed = set()
+    checked = set()
+    for entity_id, _, _, attributes_json in rows:
+        if entity_id in checked:
+            continue
+        checked.add(entity_id)
+        
+        if entity_id in known_entities:
+            continue
+            
+        if config['create_missing_entities']:
+            logger.info("Entity %s does not exist. Creating it...", entity_id)
+            # Use attributes from the first record of the entity
+            attributes = json_loads(attributes_json) if attributes_json else {}
+            if create_entity(userdata['conn'], userdata['http'], config, entity_id, attributes,
+                             userdata['has_attributes_hash']):
+                known_entities.add(entity_id)
+            else:
+                logger.error("Failed to create entity %s", entity_id)
+                failed.add(entity_id)
+        else:
+            logger.warning("Entity %s does not exist and creation is disabled", entity_id)
+    
+    if not failed:
+        return rows
+    return [row for row in rows if row[0] not in failed]
+
+def flush_batch(userdata, batch):
+    """Write a batch of queued rows to the database.
+    
+    Rows are grouped by entity and ordered by time, so each entity's states
+    and attributes are written contiguously.
+    """
+    batch.sort(key=itemgetter(0, 2))
+    rows = ensure_entities(userdata, batch)
+    if not rows:
+        return
+        
+    if insert_historical_states(userdata['conn'], rows, userdata['attr_id_cache'],
+                                userdata['has_attributes_hash']):
+        # Every written entity now has states in the database
+        userdata['known_entities'].update(row[0] for row in rows)
+        logger.info("Wrote %s historical states to database", len(rows))
+    else:
+        logger.error("Dropped %s historical states for %s after failed writes",
+                     len(rows), ", ".join(sorted(set(row[0] for row in rows))))
+
+def db_writer(userdata):
+    """Database writer thread.
+    
+    Drains the write queue and flushes rows every BATCH_SIZE records or
+    FLUSH_INTERVAL seconds, whichever comes first. A None item stops the
+    thread after flushing what is already queued.
+    """
+    write_queue = userdata['queue']
+    bulk_import_mode = userdata['config']['bulk_import_mode']
+    
+    batches = 0
+    stopping = False
+    while not stopping:
+        item = write_queue.get()
+        if item is None:
+            break
+            
+        batch = [item]
+        deadline = time.monotonic() + FLUSH_INTERVAL
+        while len(batch) < BATCH_SIZE:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = write_queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is None:
+                stopping = True
+                break
+            batch.append(item)
+        
+        try:
+            flush_batch(userdata, batch)
+            
+            # Keep the WAL from growing without bound during bulk imports and
+            # bound what a power loss can take with it
+            batches += 1
+            if bulk_import_mode and batches % BULK_CHECKPOINT_BATCHES == 0:
+                checkpoint_database(userdata['conn'], "TRUNCATE")
+        except Exception as e:
+            logger.error("Error writing batch: %s", e)
+
 def on_connect(client, userdata, flags, rc):
     """Callback for when the client connects to the MQTT broker."""
     if rc == 0:
         logger.info("Connected to MQTT broker")
         topic = userdata['config']['mqtt_topic']
         client.subscribe(topic)
-        logger.info(f"Subscribed to {topic}")
+        logger.info("Subscribed to %s", topic)
     else:
-        logger.error(f"Failed to connect to MQTT broker with code: {rc}")
+        logger.error("Failed to connect to MQTT broker with code: %s", rc)
 
-def on_message(client, userdata, msg):
-    """Callback for when a message is received from the MQTT broker."""
+def handle_message(userdata, topic, payload):
+    """Decode a received message and queue its records, off the MQTT network thread."""
     try:
-        payload = msg.payload.decode('utf-8')
-        logger.debug(f"Received message on topic {msg.topic}: {payload}")
-        
-        # Connect to Home Assistant database
-        conn = sqlite3.connect(userdata['config']['ha_database_path'])
-        
-        # Process message
-        success = process_message(conn, userdata['config'], msg.topic, payload)
+        logger.debug("Received message on topic %s (%s bytes)", topic, len(payload))
         
-        # Close connection
-        conn.close()
+        # Process message; the JSON parser takes the raw bytes directly
+        success = process_message(userdata['config'], userdata['queue'], topic, payload)
         
         if success:
-            logger.info(f"Successfully processed historical data for topic {msg.topic}")
+            logger.info("Queued historical data for topic %s", topic)
         else:
-            logger.warning(f"Failed to process historical data for topic {msg.topic}")
+            logger.warning("Failed to process historical data for topic %s", topic)
             
     except Exception as e:
-        logger.error(f"Error handling message: {e}")
+        logger.error("Error handling message: %s", e)
+
+def on_message(client, userdata, msg):
+    """Callback for when a message is received from the MQTT broker."""
+    max_payload_bytes = userdata['config']['max_payload_bytes']
+    if len(msg.payload) > max_payload_bytes:
+        logger.warning("Dropping %s byte payload on topic %s (limit %s bytes)",
+                       len(msg.payload), msg.topic, max_payload_bytes)
+        return
+        
+    # Hand off to the worker pool so the network loop keeps reading. When
+    # too many payloads are pending this blocks, pushing back on the broker
+    # instead of buffering without limit
+    pending = userdata['pending']
+    pending.acquire()
+    future = userdata['executor'].submit(handle_message, userdata, msg.topic, msg.payload)
+    future.add_done_callback(lambda _: pending.release())
+
+def handle_sigterm(signum, frame):
+    """Turn SIGTERM from the supervisor into a clean shutdown."""
+    raise KeyboardInterrupt
 
 def main():
     """Main function."""
@@ -500,12 +764,30 @@ def main():
         logger.error("Exiting due to database verification failure")
         return
     
+    # Keep one connection to the Home Assistant database for the whole run
+    conn = open_ha_database(config['ha_database_path'], config['bulk_import_mode'])
+    if config['bulk_import_mode']:
+        logger.warning("Bulk import mode enabled, database writes are not synced to disk")
+    
     # Set up MQTT client
     client_id = f"mqtt-history-injector-{uuid.uuid4().hex[:8]}"
     userdata = {
         'config': config,
+        'conn': conn,
+        'known_entities': load_known_entities(conn),
+        'attr_id_cache': {},
+        'has_attributes_hash': has_attributes_hash(conn),
+        'http': create_http_session(config),
+        'queue': queue.Queue(maxsize=WRITE_QUEUE_SIZE),
+        'executor': ThreadPoolExecutor(max_workers=2, thread_name_prefix="mqtt-worker"),
+        'pending': threading.BoundedSemaphore(MAX_PENDING_MESSAGES),
     }
     
+    # Start the database writer
+    writer = threading.Thread(target=db_writer, args=(userdata,), name="db-writer", daemon=True)
+    writer.start()
+    signal.signal(signal.SIGTERM, handle_sigterm)
+    
     client = mqtt.Client(client_id=client_id, userdata=userdata)
     client.on_connect = on_connect
     client.on_message = on_message
@@ -514,30 +796,41 @@ def main():
     if config['mqtt_username'] and config['mqtt_password']:
         client.username_pw_set(config['mqtt_username'], config['mqtt_password'])
     
-    # Connect to MQTT broker
-    connected = False
-    while not connected:
-        try:
-            client.connect(config['mqtt_host'], config['mqtt_port'], 60)
-            connected = True
-        except Exception as e:
-            logger.error(f"Failed to connect to MQTT broker: {e}")
-            logger.info("Retrying in 10 seconds...")
-            time.sleep(10)
-    
-    # Start the MQTT loop
-    client.loop_start()
-    
-    # Main loop to keep the script running
     try:
-        while True:
-            time.sleep(60)  # Sleep for a minute
+        # Connect to MQTT broker; inside the try so a stop request while the
+        # broker is unreachable still runs the cleanup below
+        connected = False
+        while not connected:
+            try:
+                client.connect(config['mqtt_host'], config['mqtt_port'], MQTT_KEEPALIVE)
+                connected = True
+            except Exception as e:
+                logger.error("Failed to connect to MQTT broker: %s", e)
+                logger.info("Retrying in 10 seconds...")
+                time.sleep(10)
+        
+        # Run the MQTT network loop on the main thread; decoding and database
+        # writes happen on the worker pool and the writer thread
+        client.loop_forever()
             
     except KeyboardInterrupt:
         logger.info("Shutting down...")
     finally:
-        client.loop_stop()
         client.disconnect()
+        userdata['executor'].shutdown(wait=True)
+        
+        # Flush whatever is still queued
+        userdata['queue'].put(None)
+        writer.join()
+        
+        if config['bulk_import_mode']:
+            # Make the imported data durable before exiting
+            try:
+                checkpoint_database(conn, "FULL")
+            except Exception as e:
+                logger.error("Error checkpointing database: %s", e)
+        conn.close()
+        userdata['http'].close()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()